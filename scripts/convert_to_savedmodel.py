@@ -24,6 +24,7 @@ search.add_argument("--pad-id", type=int, default=0, help="Pad token id when tok
 search.add_argument("--max-sequence-length", type=int, default=128, help="Max number of tokens including bos, eos")
 search.add_argument("--alpha", type=float, default=1, help="length penalty control variable when beam searching")
 search.add_argument("--beta", type=int, default=32, help="length penalty control variable when beam searching")
+search.add_argument("--jit-compile", action="store_true", help="Compile searches with XLA, the server should enable XLA JIT")
 # fmt: on
 
 
@@ -68,7 +69,7 @@ if __name__ == "__main__":
     with open(args.model_config_path) as f:
         model = create_model(args.model_name, yaml.load(f, yaml.SafeLoader))
     model.load_weights(args.model_weight_path)
-    searcher = Searcher(model, args.max_sequence_length, bos_id, eos_id, args.pad_id)
+    searcher = Searcher(model, args.max_sequence_length, bos_id, eos_id, args.pad_id, jit_compile=args.jit_compile)
     logger.info("Loaded weights of model")
 
     @tf.function(input_signature=[tf.TensorSpec([None], tf.string), tf.TensorSpec([], tf.int32)])
@@ -28,7 +28,7 @@ inference_parameters.add_argument("--pad-id", type=int, default=0, help="Pad tok
 inference_parameters.add_argument("--beam-size", type=int, default=0, help="not given, use greedy search else beam search with this value as beam size")
 
 other_settings = parser.add_argument_group("Other settings")
-other_settings.add_argument("--mixed-precision", action="store_true", help="Use mixed precision FP16")
+other_settings.add_argument("--mixed-precision", nargs="?", const="float16", choices=["float16", "bfloat16"], help="Use mixed precision FP16, or BF16 if given bfloat16")
 other_settings.add_argument("--save-pair", action="store_true", help="save result as the pairs of original and decoded sentences")
 other_settings.add_argument("--device", type=str, default="CPU", help="device to train model")
 # fmt: on
@@ -40,9 +40,8 @@ if __name__ == "__main__":
     logger = get_logger(__name__)
 
     if args.mixed_precision:
-        policy = tf.keras.mixed_precision.experimental.Policy("mixed_float16")
-        tf.keras.mixed_precision.experimental.set_policy(policy)
-        logger.info("Use Mixed Precision FP16")
+        tf.keras.mixed_precision.set_global_policy(f"mixed_{args.mixed_precision}")
+        logger.info(f"Use Mixed Precision {'BF16' if args.mixed_precision == 'bfloat16' else 'FP16'}")
 
     # Construct Dataset
     with tf.io.gfile.GFile(args.sp_model_path, "rb") as f:
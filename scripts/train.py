@@ -37,6 +37,7 @@ training_parameters.add_argument("--max-sequence-length", type=int, default=256)
 other_settings = parser.add_argument_group("Other settings")
 other_settings.add_argument("--tensorboard-update-freq", type=int, help='log losses and metrics every after this value step')
 other_settings.add_argument("--mixed-precision", action="store_true", help="Use mixed precision FP16")
+other_settings.add_argument("--jit-compile", action="store_true", help="Compile train step with XLA, it is compiled again for each new input shape")
 other_settings.add_argument("--auto-encoding", action="store_true", help="train by auto encoding with text lines dataset")
 other_settings.add_argument("--use-tfrecord", action="store_true", help="train using tfrecord dataset")
 other_settings.add_argument("--debug-nan-loss", action="store_true", help="Trainin with this flag, print the number of Nan loss (not supported on TPU)")
@@ -74,8 +75,7 @@ if __name__ == "__main__":
 
     if args.mixed_precision:
         mixed_type = "mixed_bfloat16" if args.device == "TPU" else "mixed_float16"
-        policy = tf.keras.mixed_precision.experimental.Policy(mixed_type)
-        tf.keras.mixed_precision.experimental.set_policy(policy)
+        tf.keras.mixed_precision.set_global_policy(mixed_type)
         logger.info("Use Mixed Precision FP16")
 
     # Copy config file
@@ -165,6 +165,7 @@ if __name__ == "__main__":
             if not args.debug_nan_loss
             else sparse_categorical_crossentropy,
             metrics=[tf.keras.metrics.SparseCategoricalAccuracy()],
+            jit_compile=args.jit_compile,
         )
         logger.info("Model compiling complete")
         logger.info("Start training")
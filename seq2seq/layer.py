@@ -18,6 +18,7 @@ class BiRNN(Layer):
 
     Call arguments:
         inputs: [BatchSize, SequenceLength, HiddenDim]
+        mask: Optional, [BatchSize, SequenceLength] boolean tensor, False for padding timesteps.
 
     Output Shape:
         output: `[BatchSize, SequenceLength, HiddenDim]`
@@ -40,6 +41,7 @@ class BiRNN(Layer):
             return_state=True,
             dropout=dropout,
             recurrent_dropout=recurrent_dropout,
+            dtype=self.dtype_policy,
             name="forward_rnn",
         )
         self.backward_rnn = rnn_class(
@@ -49,10 +51,13 @@ class BiRNN(Layer):
             dropout=dropout,
             recurrent_dropout=recurrent_dropout,
             go_backwards=True,
+            dtype=self.dtype_policy,
             name="backward_rnn",
         )
 
-    def call(self, inputs: tf.Tensor, initial_state: Optional[tf.Tensor] = None) -> List:
+    def call(
+        self, inputs: tf.Tensor, mask: Optional[tf.Tensor] = None, initial_state: Optional[tf.Tensor] = None
+    ) -> List:
         if initial_state is None:
             forward_states = None
             backward_states = None
@@ -61,8 +66,10 @@ class BiRNN(Layer):
             forward_states = initial_state[: num_states // 2]
             backward_states = initial_state[num_states // 2 :]
 
-        forward_output, *forward_states = self.forward_rnn(inputs, initial_state=forward_states)
-        backward_output, *backward_states = self.backward_rnn(inputs, initial_state=backward_states)
+        forward_output, *forward_states = self.forward_rnn(inputs, mask=mask, initial_state=forward_states)
+        backward_output, *backward_states = self.backward_rnn(inputs, mask=mask, initial_state=backward_states)
+        # Backward outputs are in reversed time order with padding timesteps first, so reverse them back to be aligned
+        backward_output = tf.reverse(backward_output, axis=[1])
         output = tf.concat([forward_output, backward_output], axis=-1)
         return [output] + forward_states + backward_states
 
@@ -77,6 +84,7 @@ class BahdanauAttention(Layer):
     Call arguments:
         decoder_hidden: [BatchSize, HiddenDim]
         encoder_hiddens: [BatchSize, SequenceLength, HiddenDim]
+        mask: Optional, [BatchSize, SequenceLength] float tensor, 1.0 for padding timesteps.
 
 
     Output Shape:
@@ -91,18 +99,42 @@ class BahdanauAttention(Layer):
         self.Ws = Dense(hidden_dim, name="value_converter")
         self.V = Dense(1, name="score")
 
-    def call(self, decoder_hidden: tf.Tensor, encoder_hiddens: tf.Tensor):
+    def call(self, decoder_hidden: tf.Tensor, encoder_hiddens: tf.Tensor, mask: Optional[tf.Tensor] = None):
+        return self.score(decoder_hidden, self.project_keys(encoder_hiddens), encoder_hiddens, mask)
+
+    def project_keys(self, encoder_hiddens: tf.Tensor) -> tf.Tensor:
+        """
+        Project encoder hiddens to attention keys.
+        Keys depend only on encoder hiddens, so project once and reuse them for every `score` call.
+
+        :param encoder_hiddens: [BatchSize, SequenceLength, HiddenDim]
+        :return: projected keys [BatchSize, SequenceLength, HiddenDim]
+        """
+        return self.Ws(encoder_hiddens)
+
+    def score(
+        self, decoder_hidden: tf.Tensor, keys: tf.Tensor, encoder_hiddens: tf.Tensor, mask: Optional[tf.Tensor] = None
+    ) -> tf.Tensor:
+        """
+        Attend encoder hiddens with the decoder hidden as a query.
+
+        :param decoder_hidden: [BatchSize, HiddenDim]
+        :param keys: the result of `project_keys` [BatchSize, SequenceLength, HiddenDim]
+        :param encoder_hiddens: [BatchSize, SequenceLength, HiddenDim]
+        :param mask: Optional, [BatchSize, SequenceLength] float tensor, 1.0 for padding timesteps to be ignored.
+        :return: context [BatchSize, HiddenDim]
+        """
         # [BatchSize, HiddenDim]
         query = self.Wh(decoder_hidden)
-        # [BatchSize, SequenceLength, HiddenDim]
-        values = self.Ws(encoder_hiddens)
 
         # [BatchSize, SequenceLength, 1]
-        score = self.V(tf.nn.tanh(tf.expand_dims(query, axis=1) + values))
+        score = self.V(tf.nn.tanh(tf.expand_dims(query, axis=1) + keys))
+        if mask is not None:
+            score += tf.cast(mask[:, :, tf.newaxis] * -1e9, score.dtype)
         attention = tf.nn.softmax(score, axis=1)
 
         # [BatchSize, HiddenDim]
-        context = tf.reduce_sum(attention * encoder_hiddens, axis=1)
+        context = tf.reduce_sum(attention * tf.cast(encoder_hiddens, attention.dtype), axis=1)
         return context
 
 
@@ -1,10 +1,13 @@
+import logging
 from typing import Dict, Optional, Tuple
 
 import tensorflow as tf
-from tensorflow.keras.layers import GRU, LSTM, Dense, Dropout, Embedding, Masking, SimpleRNN
+from tensorflow.keras.layers import GRU, LSTM, Dense, Dropout, Embedding, SimpleRNN
 
 from .layer import BahdanauAttention, BiRNN, PositionalEncoding, TransformerDecoderLayer, TransformerEncoderLayer
 
+logger = logging.getLogger(__name__)
+
 RNN_CELL_MAP: Dict[str, tf.keras.layers.Layer] = {
     "SimpleRNN": SimpleRNN,
     "LSTM": LSTM,
@@ -12,6 +15,18 @@ RNN_CELL_MAP: Dict[str, tf.keras.layers.Layer] = {
 }
 
 
+def get_rnn_dtype() -> Optional[str]:
+    """
+    Get dtype of RNN layers under the global mixed precision policy.
+    RNN states are kept in float32 under bfloat16 policy, because bfloat16 errors accumulate over recurrent steps.
+
+    :return: "float32" under bfloat16 policy else None to follow the global policy
+    """
+    if tf.keras.mixed_precision.global_policy().compute_dtype == "bfloat16":
+        return "float32"
+    return None
+
+
 def create_model(model_name: str, model_config: Dict) -> tf.keras.Model:
     """
     Create Seq2Seq model
@@ -90,27 +105,71 @@ class TransformerSeq2Seq(tf.keras.Model):
     def call(self, inputs: Tuple[tf.Tensor, tf.Tensor], training: Optional[bool] = None):
         if len(inputs) == 2:
             encoder_tokens, decoder_tokens = inputs
-            encoder_attention_mask = tf.expand_dims(tf.cast(encoder_tokens == self.pad_id, tf.float32), axis=1)
-            decoder_attention_mask = tf.expand_dims(tf.cast(decoder_tokens == self.pad_id, tf.float32), axis=1)
+            encoder_attention_mask = None
+            decoder_attention_mask = None
         else:
             encoder_tokens, decoder_tokens, encoder_attention_mask, decoder_attention_mask = inputs
 
-        # [BatchSize, SequenceLength, DimEmbedding]
-        encoder_input = self.embedding(encoder_tokens)
-        decoder_input = self.embedding(decoder_tokens)
+        encoder_outputs = self.encode(encoder_tokens, encoder_attention_mask, training=training)
+        return self.decode(encoder_outputs, decoder_tokens, decoder_attention_mask, training=training)
 
-        # [BatchSize, SequenceLength, DimEmbedding]
-        encoder_input = self.dropout(self.pos_encode(encoder_input))
-        decoder_input = self.dropout(self.pos_encode(decoder_input))
+    def encode(
+        self,
+        encoder_tokens: tf.Tensor,
+        encoder_attention_mask: Optional[tf.Tensor] = None,
+        training: Optional[bool] = None,
+    ) -> Tuple[tf.Tensor, tf.Tensor]:
+        """
+        Run encoder once so that the result can be reused to decode many decoder tokens.
+
+        :param encoder_tokens: encoder tokens [BatchSize, EncoderSequenceLength].
+        :param encoder_attention_mask: Optional, float attention mask [BatchSize, 1, EncoderSequenceLength].
+        :param training: whether to run in training mode.
+        :return: encoder outputs to be passed to `decode`, (encoder_output, encoder_attention_mask)
+        """
+        if encoder_attention_mask is None:
+            encoder_attention_mask = tf.expand_dims(tf.cast(encoder_tokens == self.pad_id, tf.float32), axis=1)
 
         # [BatchSize, SequenceLength, DimEmbedding]
+        encoder_input = self.dropout(self.pos_encode(self.embedding(encoder_tokens)), training=training)
         for encoder_layer in self.encoder:
-            encoder_input = encoder_layer(encoder_input, encoder_attention_mask)
+            encoder_input = encoder_layer(encoder_input, encoder_attention_mask, training=training)
+        return encoder_input, encoder_attention_mask
+
+    def decode(
+        self,
+        encoder_outputs: Tuple[tf.Tensor, tf.Tensor],
+        decoder_tokens: tf.Tensor,
+        decoder_attention_mask: Optional[tf.Tensor] = None,
+        decoder_lengths: Optional[tf.Tensor] = None,
+        training: Optional[bool] = None,
+    ) -> tf.Tensor:
+        """
+        Predict next token logits from encoder outputs and decoder tokens.
+
+        :param encoder_outputs: the result of `encode`.
+        :param decoder_tokens: decoder tokens [BatchSize, DecoderSequenceLength].
+        :param decoder_attention_mask: Optional, float attention mask [BatchSize, 1, DecoderSequenceLength].
+        :param decoder_lengths: Optional, the number of decoder tokens to predict from [BatchSize].
+            If not given, it is the number of non-padding tokens.
+        :param training: whether to run in training mode.
+        :return: logits [BatchSize, VocabSize]
+        """
+        encoder_output, encoder_attention_mask = encoder_outputs
+        if decoder_attention_mask is None:
+            decoder_attention_mask = tf.expand_dims(tf.cast(decoder_tokens == self.pad_id, tf.float32), axis=1)
+
+        # [BatchSize, SequenceLength, DimEmbedding]
+        decoder_input = self.dropout(self.pos_encode(self.embedding(decoder_tokens)), training=training)
         for decoder_layer in self.decoder:
-            decoder_input = decoder_layer(decoder_input, encoder_input, encoder_attention_mask, decoder_attention_mask)
+            decoder_input = decoder_layer(
+                decoder_input, encoder_output, encoder_attention_mask, decoder_attention_mask, training=training
+            )
 
         # [BatchSize, VocabSize]
-        output = self.dense(decoder_input[:, -1, :])
+        if decoder_lengths is None:
+            decoder_lengths = tf.reduce_sum(tf.cast(decoder_tokens != self.pad_id, tf.int32), axis=1)
+        output = self.dense(tf.gather(decoder_input, decoder_lengths - 1, batch_dims=1))
         return output
 
 
@@ -156,12 +215,14 @@ class RNNSeq2Seq(tf.keras.Model):
 
         assert cell_type in RNN_CELL_MAP, "RNN type is not valid!"
         cell_class = RNN_CELL_MAP[cell_type]
+        if cell_type == "SimpleRNN" and tf.config.list_physical_devices("GPU"):
+            logger.warning("SimpleRNN has no cuDNN kernel, consider LSTM or GRU to train on GPU")
 
+        rnn_dtype = get_rnn_dtype()
         self.embedding = Embedding(vocab_size, hidden_dim, name="embedding")
-        self.pad_masking = Masking(pad_id, name="masking")
         self.dropout = Dropout(dropout, name="dropout")
         self.encoder = [
-            BiRNN(cell_class, hidden_dim // 2, dropout, dropout, name=f"encoder_layer{i}")
+            BiRNN(cell_class, hidden_dim // 2, dropout, dtype=rnn_dtype, name=f"encoder_layer{i}")
             for i in range(num_encoder_layers)
         ]
         self.decoder = [
@@ -170,38 +231,84 @@ class RNNSeq2Seq(tf.keras.Model):
                 return_sequences=True,
                 return_state=True,
                 dropout=dropout,
-                recurrent_dropout=dropout,
+                dtype=rnn_dtype,
                 name=f"decoder_layer{i}",
             )
             for i in range(num_decoder_layers)
         ]
 
         self.dense = Dense(vocab_size, name="dense")
+        self.pad_id = pad_id
 
     def call(self, inputs: Tuple[tf.Tensor, tf.Tensor], training: Optional[bool] = None):
         encoder_tokens, decoder_tokens = inputs
+        encoder_outputs = self.encode(encoder_tokens, training=training)
+        return self.decode(encoder_outputs, decoder_tokens, training=training)
+
+    def encode(
+        self, encoder_tokens: tf.Tensor, training: Optional[bool] = None
+    ) -> Tuple[tf.Tensor, Tuple[tf.Tensor, ...]]:
+        """
+        Run encoder once so that the result can be reused to decode many decoder tokens.
+
+        :param encoder_tokens: encoder tokens [BatchSize, EncoderSequenceLength].
+        :param training: whether to run in training mode.
+        :return: encoder outputs to be passed to `decode`, (encoder_output, states)
+        """
+        encoder_mask = encoder_tokens != self.pad_id
 
         # [BatchSize, SequenceLength, HiddenDim]
-        encoder_input = self.dropout(self.pad_masking(self.embedding(encoder_tokens)))
-        decoder_input = self.dropout(self.pad_masking(self.embedding(decoder_tokens)))
+        encoder_input = self.dropout(self.embedding(encoder_tokens), training=training)
 
         # [BatchSize, SequenceLength, HiddenDim]
         states = None
         for encoder_layer in self.encoder:
-            encoder_input, *states = encoder_layer(encoder_input, initial_state=states)
+            encoder_input, *states = encoder_layer(
+                encoder_input, mask=encoder_mask, initial_state=states, training=training
+            )
 
         # Concat Forward-Backward states
         if len(states) == 2:
             states = (tf.concat(states, axis=-1),)
         elif len(states) == 4:
             states = (tf.concat(states[::2], axis=-1), tf.concat(states[1::2], axis=-1))
+        return encoder_input, states
+
+    def decode(
+        self,
+        encoder_outputs: Tuple[tf.Tensor, Tuple[tf.Tensor, ...]],
+        decoder_tokens: tf.Tensor,
+        decoder_lengths: Optional[tf.Tensor] = None,
+        training: Optional[bool] = None,
+    ) -> tf.Tensor:
+        """
+        Predict next token logits from encoder outputs and decoder tokens.
+
+        :param encoder_outputs: the result of `encode`.
+        :param decoder_tokens: decoder tokens [BatchSize, DecoderSequenceLength].
+        :param decoder_lengths: Optional, the number of decoder tokens to predict from [BatchSize].
+            If not given, padding tokens are masked.
+        :param training: whether to run in training mode.
+        :return: logits [BatchSize, VocabSize]
+        """
+        _, states = encoder_outputs
+        if decoder_lengths is None:
+            decoder_mask = decoder_tokens != self.pad_id
+        else:
+            decoder_mask = tf.sequence_mask(decoder_lengths, tf.shape(decoder_tokens)[1])
+
+        # [BatchSize, SequenceLength, HiddenDim]
+        decoder_input = self.dropout(self.embedding(decoder_tokens), training=training)
 
         # [BatchSize, SequenceLength, HiddenDim]
         for decoder_layer in self.decoder:
-            decoder_input, *states = decoder_layer(decoder_input, initial_state=states)
+            decoder_input, *states = decoder_layer(
+                decoder_input, mask=decoder_mask, initial_state=states, training=training
+            )
 
+        # The first state is the hidden output of the last non-padding timestep since the decoder is masked
         # [BatchSize, VocabSize]
-        output = self.dense(decoder_input[:, -1, :])
+        output = self.dense(states[0])
         return output
 
 
@@ -247,12 +354,14 @@ class RNNSeq2SeqWithAttention(tf.keras.Model):
 
         assert cell_type in RNN_CELL_MAP, "RNN type is not valid!"
         cell_class = RNN_CELL_MAP[cell_type]
+        if cell_type == "SimpleRNN" and tf.config.list_physical_devices("GPU"):
+            logger.warning("SimpleRNN has no cuDNN kernel, consider LSTM or GRU to train on GPU")
 
+        rnn_dtype = get_rnn_dtype()
         self.embedding = Embedding(vocab_size, hidden_dim, name="embedding")
-        self.pad_masking = Masking(pad_id, name="masking")
         self.dropout = Dropout(dropout, name="dropout")
         self.encoder = [
-            BiRNN(cell_class, hidden_dim // 2, dropout, dropout, name=f"encoder_layer{i}")
+            BiRNN(cell_class, hidden_dim // 2, dropout, dtype=rnn_dtype, name=f"encoder_layer{i}")
             for i in range(num_encoder_layers)
         ]
         self.decoder = [
@@ -261,7 +370,7 @@ class RNNSeq2SeqWithAttention(tf.keras.Model):
                 return_sequences=True,
                 return_state=True,
                 dropout=dropout,
-                recurrent_dropout=dropout,
+                dtype=rnn_dtype,
                 name=f"decoder_layer{i}",
             )
             for i in range(num_decoder_layers)
@@ -269,18 +378,35 @@ class RNNSeq2SeqWithAttention(tf.keras.Model):
 
         self.attention = BahdanauAttention(hidden_dim, name="attention")
         self.dense = Dense(vocab_size, name="dense")
+        self.pad_id = pad_id
 
     def call(self, inputs: Tuple[tf.Tensor, tf.Tensor], training: Optional[bool] = None):
         encoder_tokens, decoder_tokens = inputs
+        encoder_outputs = self.encode(encoder_tokens, training=training)
+        return self.decode(encoder_outputs, decoder_tokens, training=training)
+
+    def encode(
+        self, encoder_tokens: tf.Tensor, training: Optional[bool] = None
+    ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, Tuple[tf.Tensor, ...]]:
+        """
+        Run encoder once so that the result can be reused to decode many decoder tokens.
+
+        :param encoder_tokens: encoder tokens [BatchSize, EncoderSequenceLength].
+        :param training: whether to run in training mode.
+        :return: encoder outputs to be passed to `decode`,
+            (encoder_output, attention_keys, encoder_attention_mask, states)
+        """
+        encoder_mask = encoder_tokens != self.pad_id
 
         # [BatchSize, SequenceLength, HiddenDim]
-        encoder_input = self.dropout(self.pad_masking(self.embedding(encoder_tokens)))
-        decoder_input = self.dropout(self.pad_masking(self.embedding(decoder_tokens)))
+        encoder_input = self.dropout(self.embedding(encoder_tokens), training=training)
 
         # [BatchSize, SequenceLength, HiddenDim]
         states = None
         for encoder_layer in self.encoder:
-            encoder_input, *states = encoder_layer(encoder_input, initial_state=states)
+            encoder_input, *states = encoder_layer(
+                encoder_input, mask=encoder_mask, initial_state=states, training=training
+            )
 
         # Concat Forward-Backward states
         if len(states) == 2:
@@ -288,13 +414,52 @@ class RNNSeq2SeqWithAttention(tf.keras.Model):
         elif len(states) == 4:
             states = (tf.concat(states[::2], axis=-1), tf.concat(states[1::2], axis=-1))
 
-        decoder_output, *states = self.decoder[0](decoder_input, initial_state=states)
+        # [BatchSize, SequenceLength, HiddenDim]
+        attention_keys = self.attention.project_keys(encoder_input)
+        # [BatchSize, SequenceLength]
+        encoder_attention_mask = tf.cast(tf.logical_not(encoder_mask), tf.float32)
+        return encoder_input, attention_keys, encoder_attention_mask, states
+
+    def decode(
+        self,
+        encoder_outputs: Tuple[tf.Tensor, tf.Tensor, tf.Tensor, Tuple[tf.Tensor, ...]],
+        decoder_tokens: tf.Tensor,
+        decoder_lengths: Optional[tf.Tensor] = None,
+        training: Optional[bool] = None,
+    ) -> tf.Tensor:
+        """
+        Predict next token logits from encoder outputs and decoder tokens.
+
+        :param encoder_outputs: the result of `encode`.
+        :param decoder_tokens: decoder tokens [BatchSize, DecoderSequenceLength].
+        :param decoder_lengths: Optional, the number of decoder tokens to predict from [BatchSize].
+            If not given, padding tokens are masked.
+        :param training: whether to run in training mode.
+        :return: logits [BatchSize, VocabSize]
+        """
+        encoder_output, attention_keys, encoder_attention_mask, states = encoder_outputs
+        if decoder_lengths is None:
+            decoder_mask = decoder_tokens != self.pad_id
+        else:
+            decoder_mask = tf.sequence_mask(decoder_lengths, tf.shape(decoder_tokens)[1])
+
+        # [BatchSize, SequenceLength, HiddenDim]
+        decoder_input = self.dropout(self.embedding(decoder_tokens), training=training)
+
+        decoder_output, *states = self.decoder[0](
+            decoder_input, mask=decoder_mask, initial_state=states, training=training
+        )
         for decoder_layer in self.decoder[1:]:
-            context = self.attention(states[0], encoder_input)[:, tf.newaxis, :]
-            decoder_input = tf.concat([context, decoder_output], axis=1)
-            decoder_output, *states = decoder_layer(decoder_input, initial_state=states)
-            decoder_output = decoder_output[:, 1:, :]
+            # Context is fed as the first timestep, so only the states after it are needed
+            context = self.attention.score(states[0], attention_keys, encoder_output, encoder_attention_mask)[
+                :, tf.newaxis, :
+            ]
+            _, *states = decoder_layer(context, initial_state=states, training=training)
+            decoder_output, *states = decoder_layer(
+                decoder_output, mask=decoder_mask, initial_state=states, training=training
+            )
 
+        # The first state is the hidden output of the last non-padding timestep since the decoder is masked
         # [BatchSize, VocabSize]
-        output = self.dense(decoder_output[:, -1, :])
+        output = self.dense(states[0])
         return output
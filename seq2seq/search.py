@@ -1,74 +1,78 @@
+from typing import Sequence
+
 import tensorflow as tf
 
 
 class Searcher:
     """Provide search functions for seq2seq models"""
 
-    def __init__(self, model: tf.keras.Model, max_sequence_length: int, bos_id: int, eos_id: int, pad_id: int = 0):
+    def __init__(
+        self,
+        model: tf.keras.Model,
+        max_sequence_length: int,
+        bos_id: int,
+        eos_id: int,
+        pad_id: int = 0,
+        buckets: Sequence[int] = (32, 64, 128, 256, 512),
+        jit_compile: bool = True,
+    ):
         """
-        :param model: seq2seq model instance.
+        :param model: seq2seq model instance, providing `encode` and `decode` methods.
         :param max_sequence_length: max sequence length of decoded sequences.
         :param bos_id: bos id for decoding.
         :param eos_id: eos id for decoding.
         :param pad_id: when a sequence is shorter thans other sentences, the back token ids of the sequence is filled pad id.
+        :param buckets: encoder inputs are padded to the smallest bucket length not shorter than them,
+            so that searches are compiled once per bucket instead of once per sequence length.
+        :param jit_compile: whether to compile searches with XLA, turn off for runtimes without XLA JIT.
         """
         self.model = model
         self.max_sequence_length = max_sequence_length
         self.bos_id = bos_id
         self.eos_id = eos_id
         self.pad_id = pad_id
+        self.buckets = sorted(buckets)
+
+        # Searches are wrapped per instance so that XLA compilation can be switched
+        self._greedy_search = tf.function(
+            self._greedy_search, input_signature=[tf.TensorSpec([None, None], tf.int32)], jit_compile=jit_compile
+        )
+        self._beam_search = tf.function(
+            self._beam_search,
+            input_signature=[
+                tf.TensorSpec([None, None], tf.int32),
+                tf.TensorSpec([], tf.int32),
+                tf.TensorSpec([], tf.float64),
+                tf.TensorSpec([], tf.int32),
+            ],
+            jit_compile=jit_compile,
+        )
+
+    def _pad_to_bucket(self, encoder_input: tf.Tensor) -> tf.Tensor:
+        """
+        Pad encoder input with pad id up to the bucket length.
+        Inputs longer than every bucket are kept as they are.
+
+        :param encoder_input: seq2seq model inputs [BatchSize, EncoderSequenceLength].
+        :return: padded encoder input [BatchSize, BucketLength].
+        """
+        sequence_length = tf.shape(encoder_input)[1]
+        buckets = tf.constant(self.buckets, tf.int32)
+        larger_buckets = tf.boolean_mask(buckets, buckets >= sequence_length)
+        bucket_length = tf.cond(
+            tf.size(larger_buckets) > 0, lambda: tf.reduce_min(larger_buckets), lambda: sequence_length
+        )
+        return tf.pad(encoder_input, [[0, 0], [0, bucket_length - sequence_length]], constant_values=self.pad_id)
 
     @tf.function(input_signature=[tf.TensorSpec([None, None], tf.int32)])
     def greedy_search(self, encoder_input: tf.Tensor) -> tf.Tensor:
         """
-        Generate sentences using decoder by beam searching.
+        Generate sentences using decoder by greedy searching.
 
         :param encoder_input: seq2seq model inputs [BatchSize, EncoderSequenceLength].
         :return: generated tensor shaped. and ppl value of each generated sentences
         """
-        batch_size = tf.shape(encoder_input)[0]
-        decoder_input = tf.fill([batch_size, 1], self.bos_id)
-        log_perplexity = tf.fill([batch_size, 1], 0.0)
-        sequence_lengths = tf.fill([batch_size, 1], self.max_sequence_length)
-        is_ended = tf.zeros([batch_size, 1], tf.bool)
-
-        def _cond(decoder_input, is_ended, log_perplexity, sequence_lengths):
-            return tf.shape(decoder_input)[1] < self.max_sequence_length and not tf.reduce_all(is_ended)
-
-        def _body(decoder_input, is_ended, log_perplexity, sequence_lengths):
-            # [BatchSize, VocabSize]
-            output = self.model((encoder_input, decoder_input))
-            output = tf.nn.log_softmax(output, axis=1)
-
-            # [BatchSize, 1]
-            log_probs, new_tokens = tf.math.top_k(output)
-            log_probs, new_tokens = tf.cast(log_probs, log_perplexity.dtype), tf.cast(new_tokens, tf.int32)
-            log_perplexity = tf.where(is_ended, log_perplexity, log_perplexity + log_probs)
-            new_tokens = tf.where(is_ended, self.pad_id, new_tokens)
-            is_ended = tf.logical_or(is_ended, new_tokens == self.eos_id)
-            sequence_lengths = tf.where(new_tokens == self.eos_id, tf.shape(decoder_input)[1] + 1, sequence_lengths)
-
-            # [BatchSize, DecoderSequenceLength + 1]
-            decoder_input = tf.concat((decoder_input, new_tokens), axis=1)
-
-            return decoder_input, is_ended, log_perplexity, sequence_lengths
-
-        decoder_input, is_ended, log_perplexity, sequence_lengths = tf.while_loop(
-            _cond,
-            _body,
-            [decoder_input, is_ended, log_perplexity, sequence_lengths],
-            shape_invariants=[
-                tf.TensorSpec([None, None], tf.int32),
-                tf.TensorSpec(is_ended.get_shape(), is_ended.dtype),
-                tf.TensorSpec(log_perplexity.get_shape(), log_perplexity.dtype),
-                tf.TensorSpec(sequence_lengths.get_shape(), sequence_lengths.dtype),
-            ],
-        )
-
-        perplexity = tf.squeeze(
-            tf.pow(tf.exp(log_perplexity), tf.cast(-1 / sequence_lengths, log_perplexity.dtype)), axis=1
-        )
-        return decoder_input, perplexity
+        return self._greedy_search(self._pad_to_bucket(encoder_input))
 
     @tf.function(
         input_signature=[
@@ -96,98 +100,153 @@ class Searcher:
             decoder_input: (BatchSize, BeamSize, SequenceLength)
             perplexity: (BatchSize, BeamSize)
         """
-        batch_size = tf.shape(encoder_input)[0]
-        decoder_input = tf.fill([batch_size, 1], self.bos_id)
-        log_perplexity = tf.fill([batch_size, 1], 0.0)
-
-        def _to_sequence_lengths(decoder_single_input):
-            eos_indices = tf.where(decoder_single_input == self.eos_id)
-            if tf.size(eos_indices) == 0:
-                return tf.size(decoder_single_input, tf.int32)
-            return tf.cast(tf.math.reduce_min(eos_indices) + 1, tf.int32)
-
-        def get_sequnce_lengths(decoder_input):
-            original_shape = tf.shape(decoder_input)
-            decoder_input = tf.reshape(decoder_input, (-1, original_shape[-1]))
-            sequence_lengths = tf.map_fn(_to_sequence_lengths, decoder_input)
-            return tf.reshape(sequence_lengths, original_shape[:-1])
-
-        def has_eos(decoder_input):
-            return tf.reduce_any(decoder_input == self.eos_id, axis=-1)
-
-        def _cond(encoder_input, decoder_input, log_perplexity):
-            return tf.shape(decoder_input)[1] < self.max_sequence_length and tf.reduce_any(
-                tf.logical_not(has_eos(decoder_input))
-            )
+        return self._beam_search(self._pad_to_bucket(encoder_input), beam_size, alpha, beta)
 
-        def _body(encoder_input, decoder_input, log_perplexity):
+    def _greedy_search(self, encoder_input: tf.Tensor) -> tf.Tensor:
+        batch_size = tf.shape(encoder_input)[0]
+        encoder_outputs = self.model.encode(encoder_input, training=False)
+        # Decoded tokens are written to a fixed size buffer so that shapes never change in the loop
+        # [BatchSize, MaxSequenceLength]
+        decoder_input = tf.concat(
+            [tf.fill([batch_size, 1], self.bos_id), tf.fill([batch_size, self.max_sequence_length - 1], self.pad_id)],
+            axis=1,
+        )
+        current_len = tf.constant(1)
+        # [BatchSize]
+        batch_indices = tf.range(batch_size)
+        log_perplexity = tf.zeros([batch_size])
+        sequence_lengths = tf.fill([batch_size], self.max_sequence_length)
+        is_ended = tf.zeros([batch_size], tf.bool)
+
+        def _cond(current_len, decoder_input, is_ended, log_perplexity, sequence_lengths):
+            return current_len < self.max_sequence_length and not tf.reduce_all(is_ended)
+
+        def _body(current_len, decoder_input, is_ended, log_perplexity, sequence_lengths):
+            # Logits are casted to float32 for mixed precision models
             # [BatchSize, VocabSize]
-            output = self.model((encoder_input, decoder_input))
-            output = tf.nn.log_softmax(output, axis=1)
+            decoder_lengths = tf.fill([batch_size], current_len)
+            output = self.model.decode(encoder_outputs, decoder_input, decoder_lengths=decoder_lengths, training=False)
+            output = tf.cast(output, tf.float32)
 
-            # [BatchSize, BeamSize] at first, [BatchSize * BeamSize, BeamSize] after second loops
-            log_probs, new_tokens = tf.math.top_k(output, k=beam_size)
+            # Selecting on logits is same as on log probabilities, so only the selected logits are normalized
+            # [BatchSize]
+            log_probs, new_tokens = tf.math.top_k(output)
+            log_probs = log_probs - tf.reduce_logsumexp(output, axis=1, keepdims=True)
+            log_probs, new_tokens = log_probs[:, 0], new_tokens[:, 0]
+            log_probs, new_tokens = tf.cast(log_probs, log_perplexity.dtype), tf.cast(new_tokens, tf.int32)
+            # Ended sequences add nothing to perplexity and are filled with pad id
+            ended_mask = tf.cast(is_ended, log_perplexity.dtype)
+            log_perplexity += log_probs * (1 - ended_mask)
+            new_tokens = tf.where(is_ended, self.pad_id, new_tokens)
+            is_eos = new_tokens == self.eos_id
+            is_ended = tf.logical_or(is_ended, is_eos)
+            sequence_lengths = tf.where(is_eos, current_len + 1, sequence_lengths)
 
-            # log_probs: [BatchSize, BeamSize] at first, [BatchSize, BeamSize ** 2] after second loops
-            # new_tokens: [BatchSize, 1] at first, [BatchSize * BeamSize, 1] after second loops
-            log_probs, new_tokens = tf.reshape(log_probs, [batch_size, -1]), tf.reshape(new_tokens, [-1, 1])
-            is_end_sequences = tf.reshape(tf.repeat(has_eos(decoder_input), beam_size, axis=0), [batch_size, -1])
-            log_probs = tf.where(is_end_sequences, tf.cast(0.0, log_probs.dtype), log_probs)
-            log_probs += tf.cast(tf.repeat(log_perplexity, beam_size, axis=1), log_probs.dtype)
-
-            # Generate first token
-            if tf.shape(decoder_input)[1] == 1:
-                # [BatchSize * BeamSize, EncoderInputSequence]
-                encoder_input = tf.repeat(encoder_input, beam_size, axis=0)
-
-                # [BatchSize * BeamSize, 2]
-                decoder_input = tf.concat([tf.fill([batch_size * beam_size, 1], self.bos_id), new_tokens], axis=1)
-                log_perplexity = tf.cast(log_probs, log_perplexity.dtype)
-                return encoder_input, decoder_input, log_perplexity
-            else:
-                # [BatchSize * BeamSize, BeamSize, DecoderSequenceLength + 1]
-                decoder_input = tf.reshape(
-                    tf.concat((tf.repeat(decoder_input, beam_size, axis=0), new_tokens), axis=1),
-                    [batch_size, beam_size * beam_size, -1],
-                )
-
-            length_penalty = tf.pow((1 + get_sequnce_lengths(decoder_input)) / (1 + beta), alpha)
-            length_penalty = tf.cast(tf.reshape(length_penalty, tf.shape(log_probs)), log_probs.dtype)
-            # [BatchSize, BeamSize]
-            _, top_indices = tf.math.top_k(log_probs * length_penalty, k=beam_size)
-
-            # [BatchSize * BeamSize, 2]
-            indices_for_decoder_input = tf.concat(
-                [
-                    tf.reshape(tf.repeat(tf.range(batch_size), beam_size), [batch_size * beam_size, 1]),
-                    tf.reshape(top_indices, [batch_size * beam_size, 1]),
-                ],
-                axis=1,
+            # [BatchSize, MaxSequenceLength]
+            indices = tf.stack([batch_indices, tf.fill([batch_size], current_len)], axis=1)
+            decoder_input = tf.tensor_scatter_nd_update(decoder_input, indices, new_tokens)
+
+            return current_len + 1, decoder_input, is_ended, log_perplexity, sequence_lengths
+
+        _, decoder_input, is_ended, log_perplexity, sequence_lengths = tf.while_loop(
+            _cond, _body, [current_len, decoder_input, is_ended, log_perplexity, sequence_lengths]
+        )
+
+        perplexity = tf.exp(-log_perplexity / tf.cast(sequence_lengths, log_perplexity.dtype))
+        return decoder_input, perplexity
+
+    def _beam_search(self, encoder_input: tf.Tensor, beam_size: int, alpha: float, beta: int) -> tf.Tensor:
+        batch_size = tf.shape(encoder_input)[0]
+        encoder_outputs = self.model.encode(encoder_input, training=False)
+        # [BatchSize, MaxSequenceLength]
+        decoder_input = tf.concat(
+            [tf.fill([batch_size, 1], self.bos_id), tf.fill([batch_size, self.max_sequence_length - 1], self.pad_id)],
+            axis=1,
+        )
+
+        # Generate first tokens out of the loop, expanding each sequence to BeamSize beams
+        # [BatchSize, VocabSize]
+        decoder_lengths = tf.ones([batch_size], tf.int32)
+        output = self.model.decode(encoder_outputs, decoder_input, decoder_lengths=decoder_lengths, training=False)
+        output = tf.cast(output, tf.float32)
+
+        # [BatchSize, BeamSize]
+        log_perplexity, new_tokens = tf.math.top_k(output, k=beam_size)
+        log_perplexity = tf.cast(log_perplexity - tf.reduce_logsumexp(output, axis=1, keepdims=True), tf.float32)
+
+        # [BatchSize, BeamSize, MaxSequenceLength]
+        positions = tf.range(self.max_sequence_length)
+        decoder_input = tf.repeat(decoder_input[:, tf.newaxis, :], beam_size, axis=1)
+        decoder_input = tf.where(positions == 1, new_tokens[:, :, tf.newaxis], decoder_input)
+        current_len = tf.constant(2)
+        # [BatchSize, BeamSize]
+        is_ended = new_tokens == self.eos_id
+        sequence_lengths = tf.where(is_ended, current_len, self.max_sequence_length)
+
+        # Repeat the encoder outputs for each beam
+        encoder_outputs = tf.nest.map_structure(lambda tensor: tf.repeat(tensor, beam_size, axis=0), encoder_outputs)
+
+        # Loop invariant values
+        flat_decoder_shape = [batch_size * beam_size, self.max_sequence_length]
+        length_penalty_denominator = tf.pow(tf.cast(1 + beta, tf.float64), alpha)
+
+        def _cond(current_len, decoder_input, is_ended, sequence_lengths, log_perplexity):
+            return current_len < self.max_sequence_length and not tf.reduce_all(is_ended)
+
+        def _body(current_len, decoder_input, is_ended, sequence_lengths, log_perplexity):
+            # [BatchSize * BeamSize, VocabSize]
+            decoder_lengths = tf.fill([batch_size * beam_size], current_len)
+            output = self.model.decode(
+                encoder_outputs,
+                tf.reshape(decoder_input, flat_decoder_shape),
+                decoder_lengths=decoder_lengths,
+                training=False,
             )
+            output = tf.cast(output, tf.float32)
+            output = tf.reshape(output, [batch_size, beam_size, -1])
+
+            # [BatchSize, BeamSize, BeamSize]
+            log_probs, new_tokens = tf.math.top_k(output, k=beam_size)
+            log_probs = tf.cast(log_probs - tf.reduce_logsumexp(output, axis=2, keepdims=True), log_perplexity.dtype)
+            log_probs = tf.where(is_ended[:, :, tf.newaxis], 0.0, log_probs) + log_perplexity[:, :, tf.newaxis]
+
+            # Candidates of an ended beam keep its length, the others are as long as current_len + 1
+            # [BatchSize, BeamSize, 1]
+            candidate_lengths = tf.where(is_ended, sequence_lengths, current_len + 1)[:, :, tf.newaxis]
+            length_penalty = tf.pow(tf.cast(1 + candidate_lengths, tf.float64), alpha) / length_penalty_denominator
+            length_penalty = tf.cast(length_penalty, log_probs.dtype)
+
+            # [BatchSize, BeamSize ** 2]
+            scores = tf.reshape(log_probs * length_penalty, [batch_size, -1])
+            log_probs, new_tokens = tf.reshape(log_probs, [batch_size, -1]), tf.reshape(new_tokens, [batch_size, -1])
+            # [BatchSize, BeamSize]
+            _, top_indices = tf.math.top_k(scores, k=beam_size)
 
-            # [BatchSize * BeamSize, DecoderSequenceLength]
-            decoder_input = tf.gather_nd(decoder_input, indices_for_decoder_input)
-            log_perplexity = tf.cast(tf.gather_nd(log_probs, indices_for_decoder_input), log_perplexity.dtype)
-            log_perplexity = tf.reshape(log_perplexity, [batch_size, beam_size])
+            # Gather only the parent beams of selected candidates and write their new tokens
+            # [BatchSize, BeamSize, MaxSequenceLength]
+            parent_indices = top_indices // beam_size
+            decoder_input = tf.gather(decoder_input, parent_indices, batch_dims=1)
+            new_tokens = tf.gather(new_tokens, top_indices, batch_dims=1)
+            decoder_input = tf.where(positions == current_len, new_tokens[:, :, tf.newaxis], decoder_input)
 
-            return encoder_input, decoder_input, log_perplexity
+            # Selected beams are ended if their parents are ended or they have just generated eos
+            # [BatchSize, BeamSize]
+            is_parent_ended = tf.gather(is_ended, parent_indices, batch_dims=1)
+            is_new_ended = tf.logical_and(tf.logical_not(is_parent_ended), new_tokens == self.eos_id)
+            sequence_lengths = tf.gather(sequence_lengths, parent_indices, batch_dims=1)
+            sequence_lengths = tf.where(is_new_ended, current_len + 1, sequence_lengths)
+            is_ended = tf.logical_or(is_parent_ended, is_new_ended)
+            log_perplexity = tf.gather(log_probs, top_indices, batch_dims=1)
 
-        encoder_input, decoder_input, log_perplexity = tf.while_loop(
-            _cond,
-            _body,
-            [encoder_input, decoder_input, log_perplexity],
-            shape_invariants=[
-                tf.TensorSpec([None, None], tf.int32),
-                tf.TensorSpec([None, None], tf.int32),
-                tf.TensorSpec([None, None]),
-            ],
+            return current_len + 1, decoder_input, is_ended, sequence_lengths, log_perplexity
+
+        _, decoder_input, _, sequence_lengths, log_perplexity = tf.while_loop(
+            _cond, _body, [current_len, decoder_input, is_ended, sequence_lengths, log_perplexity]
         )
 
-        decoder_input = tf.reshape(decoder_input, [batch_size, beam_size, -1])
-        sequence_lengths = get_sequnce_lengths(decoder_input)
         decoder_input = tf.where(
-            tf.sequence_mask(sequence_lengths, tf.shape(decoder_input)[2]), decoder_input, self.pad_id
+            tf.sequence_mask(sequence_lengths, self.max_sequence_length), decoder_input, self.pad_id
         )
-        perplexity = tf.pow(tf.exp(log_perplexity), tf.cast(-1 / sequence_lengths, log_perplexity.dtype))
+        perplexity = tf.exp(-log_perplexity / tf.cast(sequence_lengths, log_perplexity.dtype))
 
         return decoder_input, perplexity
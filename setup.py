@@ -10,7 +10,7 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     python_requires=">=3.6",
-    install_requires=["tensorflow>=2"],
+    install_requires=["tensorflow>=2.8"],
     url="https://github.com/psj8252/seq2seq.git",
     author="Park Sangjun",
     keywords=["seq2seq", "rnn", "attention", "transformer"],
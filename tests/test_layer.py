@@ -32,6 +32,20 @@ def test_bi_rnn_shape(rnn_class, units, dropout, recurrent_dropout, batch_size,
     tf.debugging.assert_equal(tf.shape(states[0]), [batch_size, units])
 
 
+def test_bi_rnn_padding():
+    birnn = BiRNN(GRU, 16)
+
+    inputs = tf.random.uniform([4, 10, 16])
+    padded_inputs = tf.pad(inputs, [[0, 0], [0, 5], [0, 0]])
+    mask = tf.sequence_mask(tf.fill([4], 10), 15)
+    output, *states = birnn(inputs)
+    padded_output, *padded_states = birnn(padded_inputs, mask=mask)
+
+    tf.debugging.assert_near(padded_output[:, :10], output)
+    for state, padded_state in zip(states, padded_states):
+        tf.debugging.assert_near(padded_state, state)
+
+
 def test_bahdanau_attention_shape():
     batch_size = 4
     hidden_dim = 123
@@ -43,6 +57,26 @@ def test_bahdanau_attention_shape():
     output = attention(*inputs)
     tf.debugging.assert_equal(tf.shape(output), [batch_size, hidden_dim])
 
+    keys = attention.project_keys(inputs[1])
+    tf.debugging.assert_near(attention.score(inputs[0], keys, inputs[1]), output)
+
+
+def test_bahdanau_attention_mask():
+    batch_size = 4
+    hidden_dim = 16
+    sequence_length = 10
+    padding_length = 3
+
+    decoder_hidden = tf.random.normal((batch_size, hidden_dim))
+    encoder_hiddens = tf.random.normal((batch_size, sequence_length, hidden_dim))
+    padded_encoder_hiddens = tf.concat([encoder_hiddens, tf.random.normal((batch_size, padding_length, hidden_dim))], 1)
+    mask = tf.concat([tf.zeros((batch_size, sequence_length)), tf.ones((batch_size, padding_length))], axis=1)
+    attention = BahdanauAttention(hidden_dim)
+
+    output = attention(decoder_hidden, encoder_hiddens)
+    masked_output = attention(decoder_hidden, padded_encoder_hiddens, mask)
+    tf.debugging.assert_near(output, masked_output)
+
 
 def test_scaled_dotproduct_attention_shape():
     batch_size = 4
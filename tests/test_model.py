@@ -1,7 +1,32 @@
 import pytest
 import tensorflow as tf
 
-from seq2seq.model import RNNSeq2Seq
+from seq2seq.model import RNNSeq2Seq, create_model
+
+VOCAB_SIZE = 128
+RNN_CONFIG = {
+    "cell_type": "LSTM",
+    "vocab_size": VOCAB_SIZE,
+    "hidden_dim": 64,
+    "num_encoder_layers": 2,
+    "num_decoder_layers": 2,
+    "dropout": 0.0,
+}
+TRANSFORMER_CONFIG = {
+    "vocab_size": VOCAB_SIZE,
+    "dim_embedding": 64,
+    "num_heads": 4,
+    "num_encoder_layers": 2,
+    "num_decoder_layers": 2,
+    "dim_feedfoward": 128,
+    "activation": "relu",
+    "dropout": 0.0,
+}
+MODEL_CONFIGS = [
+    ("RNNSeq2Seq", RNN_CONFIG),
+    ("RNNSeq2SeqWithAttention", RNN_CONFIG),
+    ("TransformerSeq2Seq", TRANSFORMER_CONFIG),
+]
 
 
 def test_model():
@@ -31,3 +56,48 @@ def test_model():
 
     with pytest.raises(Exception):
         model(tf.constant([[30]]))
+
+
+@pytest.mark.parametrize("model_name,model_config", MODEL_CONFIGS)
+def test_encode_decode(model_name, model_config):
+    batch_size = 4
+
+    model = create_model(model_name, model_config)
+    encoder_tokens = tf.random.uniform((batch_size, 12), maxval=VOCAB_SIZE, dtype=tf.int32)
+    decoder_tokens = tf.random.uniform((batch_size, 16), maxval=VOCAB_SIZE, dtype=tf.int32)
+
+    output = model((encoder_tokens, decoder_tokens))
+    decoded_output = model.decode(model.encode(encoder_tokens), decoder_tokens)
+    tf.debugging.assert_near(output, decoded_output)
+
+
+@pytest.mark.parametrize("model_name,model_config", MODEL_CONFIGS)
+def test_decode_with_lengths(model_name, model_config):
+    batch_size = 4
+
+    model = create_model(model_name, model_config)
+    encoder_tokens = tf.random.uniform((batch_size, 12), minval=1, maxval=VOCAB_SIZE, dtype=tf.int32)
+    decoder_tokens = tf.random.uniform((batch_size, 8), minval=1, maxval=VOCAB_SIZE, dtype=tf.int32)
+    # Padding tokens generated in the middle of sequences are decoded like the other tokens
+    decoder_tokens = tf.tensor_scatter_nd_update(decoder_tokens, [[i, 3] for i in range(batch_size)], [0] * batch_size)
+    padded_decoder_tokens = tf.pad(decoder_tokens, [[0, 0], [0, 4]])
+    encoder_outputs = model.encode(encoder_tokens)
+
+    decoder_lengths = tf.fill([batch_size], 8)
+    output = model.decode(encoder_outputs, decoder_tokens, decoder_lengths=decoder_lengths)
+    padded_output = model.decode(encoder_outputs, padded_decoder_tokens, decoder_lengths=decoder_lengths)
+    tf.debugging.assert_near(padded_output, output)
+
+
+@pytest.mark.parametrize("model_name,model_config", MODEL_CONFIGS)
+def test_encoder_padding(model_name, model_config):
+    batch_size = 4
+
+    model = create_model(model_name, model_config)
+    encoder_tokens = tf.random.uniform((batch_size, 12), minval=1, maxval=VOCAB_SIZE, dtype=tf.int32)
+    padded_encoder_tokens = tf.pad(encoder_tokens, [[0, 0], [0, 5]])
+    decoder_tokens = tf.random.uniform((batch_size, 16), minval=1, maxval=VOCAB_SIZE, dtype=tf.int32)
+
+    output = model.decode(model.encode(encoder_tokens), decoder_tokens)
+    padded_output = model.decode(model.encode(padded_encoder_tokens), decoder_tokens)
+    tf.debugging.assert_near(padded_output, output)
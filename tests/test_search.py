@@ -1,8 +1,28 @@
+import pytest
 import tensorflow as tf
 
-from seq2seq.model import RNNSeq2Seq
+from seq2seq.model import RNNSeq2Seq, create_model
 from seq2seq.search import Searcher
 
+RNN_CONFIG = {
+    "cell_type": "GRU",
+    "vocab_size": 100,
+    "hidden_dim": 32,
+    "num_encoder_layers": 2,
+    "num_decoder_layers": 2,
+    "dropout": 0.0,
+}
+TRANSFORMER_CONFIG = {
+    "vocab_size": 100,
+    "dim_embedding": 32,
+    "num_heads": 2,
+    "num_encoder_layers": 2,
+    "num_decoder_layers": 2,
+    "dim_feedfoward": 64,
+    "activation": "relu",
+    "dropout": 0.0,
+}
+
 
 def test_search():
     model = RNNSeq2Seq(
@@ -36,3 +56,71 @@ def test_search():
 
     tf.debugging.assert_equal(beam_result[:, 0, :], greedy_result)
     tf.debugging.assert_near(tf.squeeze(beam_ppl), greedy_ppl)
+
+
+@pytest.mark.parametrize(
+    "model_name,model_config",
+    [
+        ("RNNSeq2Seq", RNN_CONFIG),
+        ("RNNSeq2SeqWithAttention", RNN_CONFIG),
+        ("TransformerSeq2Seq", TRANSFORMER_CONFIG),
+    ],
+)
+def test_search_bucketing(model_name, model_config):
+    model = create_model(model_name, model_config)
+
+    encoder_input = tf.random.uniform((4, 10), minval=1, maxval=100, dtype=tf.int32)
+    model((encoder_input, encoder_input))
+
+    bucketed_searcher = Searcher(model, 17, 2, 3, buckets=(16, 32))
+    searcher = Searcher(model, 17, 2, 3, buckets=())
+
+    bucketed_result, bucketed_ppl = bucketed_searcher.greedy_search(encoder_input)
+    result, ppl = searcher.greedy_search(encoder_input)
+    tf.debugging.assert_equal(bucketed_result, result)
+    tf.debugging.assert_near(bucketed_ppl, ppl)
+
+    bucketed_result, bucketed_ppl = bucketed_searcher.beam_search(encoder_input, 3)
+    result, ppl = searcher.beam_search(encoder_input, 3)
+    tf.debugging.assert_equal(bucketed_result, result)
+    tf.debugging.assert_near(bucketed_ppl, ppl)
+
+
+def test_search_without_jit_compile():
+    model = create_model("RNNSeq2SeqWithAttention", RNN_CONFIG)
+
+    encoder_input = tf.random.uniform((4, 10), minval=1, maxval=100, dtype=tf.int32)
+    model((encoder_input, encoder_input))
+
+    searcher = Searcher(model, 17, 2, 3)
+    eager_searcher = Searcher(model, 17, 2, 3, jit_compile=False)
+
+    result, ppl = searcher.beam_search(encoder_input, 3)
+    eager_result, eager_ppl = eager_searcher.beam_search(encoder_input, 3)
+    tf.debugging.assert_equal(eager_result, result)
+    tf.debugging.assert_near(eager_ppl, ppl)
+
+
+@pytest.mark.parametrize("model_name", ["RNNSeq2Seq", "RNNSeq2SeqWithAttention"])
+def test_search_bfloat16(model_name):
+    tf.keras.mixed_precision.set_global_policy("mixed_bfloat16")
+    try:
+        model = create_model(model_name, RNN_CONFIG)
+    finally:
+        tf.keras.mixed_precision.set_global_policy("float32")
+
+    encoder_input = tf.random.uniform((4, 10), minval=1, maxval=100, dtype=tf.int32)
+    model((encoder_input, encoder_input))
+    assert model.embedding.compute_dtype == "bfloat16"
+    assert model.dense.compute_dtype == "bfloat16"
+    assert all(layer.forward_rnn.compute_dtype == "float32" for layer in model.encoder)
+    assert all(layer.backward_rnn.compute_dtype == "float32" for layer in model.encoder)
+    assert all(layer.compute_dtype == "float32" for layer in model.decoder)
+
+    searcher = Searcher(model, 17, 2, 3)
+    beam_result, beam_ppl = searcher.beam_search(encoder_input, 1)
+    greedy_result, greedy_ppl = searcher.greedy_search(encoder_input)
+
+    tf.debugging.assert_equal(beam_result[:, 0, :], greedy_result)
+    tf.debugging.assert_near(tf.squeeze(beam_ppl, axis=1), greedy_ppl)
+    tf.debugging.assert_all_finite(greedy_ppl, "perplexity should be finite")